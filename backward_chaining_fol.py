@@ -1,133 +1,312 @@
 import copy
+import itertools
 from collections import defaultdict
+from weakref import WeakValueDictionary
 
-class Expr:
-    """Base class for all expressions (Variable, Constant, Function, Predicate)."""
-    pass
+# Hash-consing table: structural key -> the one live instance of that term.
+# Terms are immutable once built, so structurally equal terms can share an
+# object; equality is then identity and the hash is computed once.
+_INTERN = WeakValueDictionary()
 
-class Variable(Expr):
-    def __init__(self, name):
-        self.name = name
+# Integer kind tags, so hot loops dispatch on an int field instead of
+# isinstance() chains. Compound kinds compare >= FUNC.
+VAR, CONST, FUNC, PRED = range(4)
 
-    def __repr__(self):
-        return self.name
+class Expr:
+    """Base class for all expressions (Variable, Constant, Function, Predicate)."""
+    __slots__ = ('_hash', '__weakref__')  # __weakref__ for the _INTERN table
 
     def __eq__(self, other):
-        return isinstance(other, Variable) and self.name == other.name
+        return self is other
 
     def __hash__(self):
-        return hash(("Variable", self.name))
+        return self._hash
 
-class Constant(Expr):
-    def __init__(self, name):
-        self.name = name
+_VID_COUNTER = itertools.count(1)
+
+class Variable(Expr):
+    """A logic variable.
+
+    Variable(name) is the user-facing variable of that name. standardize_apart
+    makes fresh ones with Variable(name, next(_VID_COUNTER)): the integer vid
+    keeps them distinct without formatting a new name string per rename.
+    """
+    __slots__ = ('name', 'vid', 'vars')
+    kind = VAR
+    ground = False
+
+    def __new__(cls, name, vid=None):
+        key = ("Variable", name, vid)
+        self = _INTERN.get(key)
+        if self is None:
+            self = _INTERN[key] = super().__new__(cls)
+            self.name = name
+            self.vid = vid
+            self._hash = hash(key)
+            self.vars = frozenset((self,))
+        return self
 
     def __repr__(self):
-        return self.name
+        if self.vid is None:
+            return self.name
+        return f"_{self.name}{self.vid}"
 
-    def __eq__(self, other):
-        return isinstance(other, Constant) and self.name == other.name
+class Constant(Expr):
+    __slots__ = ('name',)
+    kind = CONST
+    ground = True
+    vars = frozenset()
+
+    def __new__(cls, name):
+        key = ("Constant", name)
+        self = _INTERN.get(key)
+        if self is None:
+            self = _INTERN[key] = super().__new__(cls)
+            self.name = name
+            self._hash = hash(key)
+        return self
 
-    def __hash__(self):
-        return hash(("Constant", self.name))
+    def __repr__(self):
+        return self.name
 
 class Function(Expr):
-    def __init__(self, name, args):
-        self.name = name
-        self.args = args  # list of Expr
+    __slots__ = ('name', 'args', 'ground', 'vars')
+    kind = FUNC
+
+    def __new__(cls, name, args):
+        args = tuple(args)
+        key = ("Function", name, args)
+        self = _INTERN.get(key)
+        if self is None:
+            self = _INTERN[key] = super().__new__(cls)
+            self.name = name
+            self.args = args  # tuple of Expr
+            self.ground = all(arg.ground for arg in args)  # no Variable anywhere below
+            self.vars = frozenset().union(*(arg.vars for arg in args))  # Variables anywhere below
+            self._hash = hash(key)
+        return self
 
     def __repr__(self):
         return f"{self.name}({', '.join(map(str, self.args))})"
 
-    def __eq__(self, other):
-        return isinstance(other, Function) and self.name == other.name and self.args == other.args
-
-    def __hash__(self):
-        return hash(("Function", self.name, tuple(self.args)))
-
 class Predicate(Expr):
-    def __init__(self, name, args):
-        self.name = name
-        self.args = args  # list of Expr
+    __slots__ = ('name', 'args', 'ground', 'vars')
+    kind = PRED
+
+    def __new__(cls, name, args):
+        args = tuple(args)
+        key = ("Predicate", name, args)
+        self = _INTERN.get(key)
+        if self is None:
+            self = _INTERN[key] = super().__new__(cls)
+            self.name = name
+            self.args = args  # tuple of Expr
+            self.ground = all(arg.ground for arg in args)  # no Variable anywhere below
+            self.vars = frozenset().union(*(arg.vars for arg in args))  # Variables anywhere below
+            self._hash = hash(key)
+        return self
 
     def __repr__(self):
         return f"{self.name}({', '.join(map(str, self.args))})"
 
-    def __eq__(self, other):
-        return isinstance(other, Predicate) and self.name == other.name and self.args == other.args
-
-    def __hash__(self):
-        return hash(("Predicate", self.name, tuple(self.args)))
-
 # -------------------------
 # Substitution (theta) functions
 # -------------------------
 
-def is_variable(x):
-    """Check if x is a Variable."""
-    return isinstance(x, Variable)
+_MISSING = object()
+
+class Theta:
+    """Persistent substitution mapping Variable -> Expr.
+
+    Stored as a chain of (parent, var, x) cells, so extend() is O(1) and shares
+    every existing binding with its parent instead of copying them. Lookups walk
+    the chain back to the empty root.
+
+    The hash is kept incrementally as the XOR of the hashes of all (var, x)
+    bindings, so it is O(1) per extension and independent of binding order;
+    equal substitutions hash equal however they were built.
+    """
+    __slots__ = ('parent', 'var', 'x', 'hash_')
+
+    def __init__(self, parent=None, var=None, x=None):
+        self.parent = parent
+        self.var = var
+        self.x = x
+        self.hash_ = 0 if parent is None else parent.hash_ ^ hash((var, x))
+
+    def extend(self, var, x):
+        """Return a new Theta with var bound to x."""
+        return Theta(self, var, x)
+
+    def get(self, var, default=None):
+        node = self
+        while node.parent is not None:
+            if node.var is var:
+                return node.x
+            node = node.parent
+        return default
+
+    def __getitem__(self, var):
+        x = self.get(var, _MISSING)
+        if x is _MISSING:
+            raise KeyError(var)
+        return x
+
+    def __contains__(self, var):
+        return self.get(var, _MISSING) is not _MISSING
+
+    def items(self):
+        """Bindings in the order they were made."""
+        pairs = []
+        node = self
+        while node.parent is not None:
+            pairs.append((node.var, node.x))
+            node = node.parent
+        return pairs[::-1]
+
+    def __len__(self):
+        return len(self.items())
+
+    def __hash__(self):
+        return self.hash_
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Theta) or self.hash_ != other.hash_:
+            return False
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return "{" + ", ".join(f"{var!r}: {x!r}" for var, x in self.items()) + "}"
+
 
+def deref(x, theta):
+    """Follow variable bindings in theta from x to the term they end at.
 
-def is_compound(x):
-    """Check if x is a composite term (Function or Predicate)."""
-    return isinstance(x, (Function, Predicate))
+    Only the variable chain is walked; unlike substitute, nothing inside a
+    compound is rewritten, so this never allocates.
+    """
+    while x.kind == VAR:
+        bound = theta.get(x, _MISSING)
+        if bound is _MISSING:
+            break
+        x = bound
+    return x
 
 
 def occurs_check(var, x, theta):
-    """Prevent cyclic substitutions: var cannot appear in x under current theta."""
-    x = substitute(x, theta)
-    if var == x:
-        return True
-    if is_compound(x):
-        for arg in x.args:
-            if occurs_check(var, arg, theta):
+    """Prevent cyclic substitutions: var cannot appear in x under current theta.
+
+    Walks the binding graph from x's cached variable set rather than
+    substituting x, visiting each bound variable at most once.
+    """
+    stack = [x]
+    seen = set()
+    while stack:
+        t = stack.pop()
+        for v in t.vars:
+            if v is var:
                 return True
+            if v not in seen:
+                seen.add(v)
+                bound = theta.get(v, _MISSING)
+                if bound is not _MISSING:
+                    stack.append(bound)
     return False
 
 
-def unify(x, y, theta):
-    """Unify two expressions x and y given substitution theta. Return extended theta or None on failure."""
+def unify(x, y, theta, check_occurs=True):
+    """Unify two expressions x and y given substitution theta. Return extended theta or None on failure.
+
+    Runs over an explicit stack of (x, y) pairs. Each side is dereferenced
+    (see deref), and matching compounds push their argument pairs directly, so
+    no substituted copy of either term is built. check_occurs=False skips the
+    occurs check, as most Prolog systems do.
+    """
     if theta is None:
         return None
-    if x == y:
-        return theta
-    x = substitute(x, theta)
-    y = substitute(y, theta)
-    if is_variable(x):
-        return unify_var(x, y, theta)
-    if is_variable(y):
-        return unify_var(y, x, theta)
-    if is_compound(x) and is_compound(y) and x.__class__ == y.__class__ and x.name == y.name and len(x.args) == len(y.args):
-        for x_arg, y_arg in zip(x.args, y.args):
-            theta = unify(x_arg, y_arg, theta)
-            if theta is None:
+    if x.ground and y.ground:
+        # Hash-consed ground terms are equal exactly when they are identical.
+        return theta if x is y else None
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        x = deref(x, theta)
+        y = deref(y, theta)
+        if x is y:
+            continue
+        if x.ground and y.ground:
+            return None
+        x_kind, y_kind = x.kind, y.kind
+        if y_kind == VAR and x_kind != VAR:
+            x, y = y, x
+            x_kind, y_kind = y_kind, x_kind
+        if x_kind == VAR:
+            if check_occurs and occurs_check(x, y, theta):
                 return None
-        return theta
-    return None
+            theta = theta.extend(x, y)
+        elif x_kind == y_kind >= FUNC and x.name == y.name and len(x.args) == len(y.args):
+            # Reversed so arguments are unified left to right.
+            stack.extend(zip(reversed(x.args), reversed(y.args)))
+        else:
+            return None
+    return theta
 
 
-def unify_var(var, x, theta):
-    """Handle variable unification under theta, ensuring no circular refs."""
-    if var in theta:
-        return unify(theta[var], x, theta)
-    if is_variable(x) and x in theta:
-        return unify(var, theta[x], theta)
-    if occurs_check(var, x, theta):
-        return None
-    new_theta = theta.copy()
-    new_theta[var] = x
-    return new_theta
+def substitute(x, theta):
+    """Apply substitution theta to term or predicate x.
+
+    Ground subterms are returned as-is. Works bottom-up over an explicit stack,
+    memoizing each rebuilt subterm so shared subterms and repeated variables
+    are only rebuilt once. Raises ValueError on a cyclic binding, which can
+    only arise with the occurs check turned off.
+    """
+    if x.ground:
+        return x
+    memo = {}
+    expanding = set()  # bound variables whose binding is still being rebuilt
+    stack = [x]
+    while stack:
+        t = stack[-1]
+        if t in memo:
+            stack.pop()
+        elif t.ground:
+            memo[t] = t
+            stack.pop()
+        elif t.kind == VAR:
+            bound = theta.get(t, _MISSING)
+            if bound is _MISSING:
+                memo[t] = t
+                stack.pop()
+            elif bound in memo:
+                memo[t] = memo[bound]
+                expanding.discard(t)
+                stack.pop()
+            elif t in expanding:
+                raise ValueError(f"cyclic binding: {t!r} occurs in its own value {bound!r}")
+            else:
+                expanding.add(t)
+                stack.append(bound)
+        else:
+            pending = [arg for arg in t.args if arg not in memo]
+            if pending:
+                stack.extend(pending)
+            else:
+                memo[t] = t.__class__(t.name, tuple(memo[arg] for arg in t.args))
+                stack.pop()
+    return memo[x]
 
 
-def substitute(x, theta):
-    """Apply substitution theta to term or predicate x."""
-    if isinstance(x, Variable):
-        return substitute(theta[x], theta) if x in theta else x
-    if isinstance(x, Function):
-        return Function(x.name, [substitute(arg, theta) for arg in x.args])
-    if isinstance(x, Predicate):
-        return Predicate(x.name, [substitute(arg, theta) for arg in x.args])
-    return x  # Constant
+def goal_instance(goal, theta, check_occurs=True):
+    """goal under theta, as the solver selects and resolves it.
+
+    Without the occurs check theta may hold cyclic bindings, which substitute
+    rejects, so only the arguments are dereferenced; unify follows the rest.
+    """
+    if check_occurs:
+        return substitute(goal, theta)
+    return Predicate(goal.name, tuple(deref(arg, theta) for arg in goal.args))
 
 # -------------------------
 # Knowledge Base Representation
@@ -135,30 +314,102 @@ def substitute(x, theta):
 
 class Clause:
     """Horn clause: head <- body. If body is empty, it's a fact."""
+    __slots__ = ('head', 'body', 'has_vars', 'ground_fact',
+                 'head_vars', 'local_vars', 'match', 'instantiate')
+
     def __init__(self, head, body=None):
         self.head = head            # Predicate
         self.body = body or []      # list of Predicates (conjunction)
+        self.has_vars = not (head.ground and all(b.ground for b in self.body))
+        self.ground_fact = not self.body and not self.has_vars
+        # Filled in by KnowledgeBase.add_clause; see compile_matcher.
+        self.head_vars = ()
+        self.local_vars = ()
+        self.match = None
+        self.instantiate = None
 
     def __repr__(self):
         if not self.body:
             return f"{self.head}."
         return f"{self.head} <- {', '.join(map(str, self.body))}."
 
+def first_arg_key(pred):
+    """Index key for a predicate's first argument.
+
+    ('C', name) for a Constant, ('F', name, arity) for a Function, and '*' when
+    the first argument is a Variable (or there are no arguments).
+    """
+    if not pred.args:
+        return '*'
+    arg = pred.args[0]
+    if arg.kind == CONST:
+        return ('C', arg.name)
+    if arg.kind == FUNC:
+        return ('F', arg.name, len(arg.args))
+    return '*'
+
 class KnowledgeBase:
-    """Collection of Horn clauses, indexed by predicate name and arity."""
-    def __init__(self):
+    """Collection of Horn clauses, indexed by predicate name, arity and first argument.
+
+    occurs_check=False trades soundness on cyclic terms for faster unification.
+    tabling=True enables answer tables (see solve); clear_tables() frees them.
+    reorder_goals=False solves conjunctions strictly left to right (see select_goal).
+    """
+    def __init__(self, occurs_check=True, tabling=False, reorder_goals=True):
         self.clauses = []
-        self.index = defaultdict(lambda: defaultdict(list))  # name -> arity -> [Clause]
+        self.occurs_check = occurs_check
+        self.tabling = tabling
+        self.reorder_goals = reorder_goals
+        self.tables = {}  # variant_key(goal) -> [answer instances of goal]
+        self.prunes = 0   # bumped on every cycle cut; see solve
+        # name -> arity -> first_arg_key -> [Clause]. Every bucket also holds the
+        # '*' (variable first argument) clauses and stays in insertion order, and
+        # the None bucket holds every clause for goals whose first arg is unbound.
+        self.index = defaultdict(lambda: defaultdict(dict))
+        self.fact_set = defaultdict(set)  # (name, arity) -> {args of ground facts}
+        self.rule_preds = set()  # (name, arity) with any rule or non-ground fact
 
     def add_clause(self, clause):
         """Add a clause (fact or rule) to the KB."""
         self.clauses.append(clause)
-        key = (clause.head.name, len(clause.head.args))
-        self.index[clause.head.name][len(clause.head.args)].append(clause)
+        self.clear_tables()  # cached answers may now be incomplete
+        compile_matcher(clause)
+        if clause.ground_fact:
+            self.fact_set[(clause.head.name, len(clause.head.args))].add(clause.head.args)
+        else:
+            self.rule_preds.add((clause.head.name, len(clause.head.args)))
+        buckets = self.index[clause.head.name][len(clause.head.args)]
+        if not buckets:
+            buckets[None] = []
+            buckets['*'] = []
+        buckets[None].append(clause)
+        key = first_arg_key(clause.head)
+        if key == '*':
+            for bucket_key, bucket in buckets.items():
+                if bucket_key is not None:
+                    bucket.append(clause)
+        else:
+            if key not in buckets:
+                buckets[key] = list(buckets['*'])
+            buckets[key].append(clause)
+
+    def clear_tables(self):
+        """Drop all tabled answers; later queries rebuild them on demand."""
+        self.tables.clear()
 
     def fetch_clauses_for_goal(self, goal):
-        """Retrieve all clauses whose head matches goal's predicate name and arity."""
-        return self.index.get(goal.name, {}).get(len(goal.args), [])
+        """Retrieve the clauses whose head could unify with goal.
+
+        Matches predicate name and arity, then narrows by goal's first argument
+        (first-argument indexing) when it is bound.
+        """
+        buckets = self.index.get(goal.name, {}).get(len(goal.args))
+        if not buckets:
+            return []
+        key = first_arg_key(goal)
+        if key == '*':
+            return buckets[None]
+        return buckets.get(key, buckets['*'])
 
     def ask(self, query):
         """Public interface to ask a single query or a list of conjunctive queries.
@@ -166,71 +417,376 @@ class KnowledgeBase:
         """
         if isinstance(query, list):
             # Conjunctive query: ask [G1, G2, ...]
-            yield from fol_bc_and(self, query, {}, set())
+            yield from solve(self, query, Theta())
         else:
             # Single goal
-            yield from fol_bc_or(self, query, {}, set())
+            yield from solve(self, [query], Theta())
 
 # -------------------------
 # Backward Chaining Algorithm
 # -------------------------
 
-def fol_bc_or(kb, goal, theta, visited):
-    """OR node: try all clauses whose head can unify with goal."""
-    # Avoid infinite loops: check if this goal+theta was already visited
-    current = substitute(goal, theta)
-    if (repr(current), frozenset(theta.items())) in visited:
-        return
-    new_visited = visited.copy()
-    new_visited.add((repr(current), frozenset(theta.items())))
+def on_path(key, frame):
+    """Check whether key belongs to a goal on the current proof path.
 
-    for clause in kb.fetch_clauses_for_goal(goal):
-        clause_copy = standardize_apart(clause)
-        head, body = clause_copy.head, clause_copy.body
-        theta_prime = unify(head, current, theta)
-        if theta_prime is not None:
-            if not body:
-                # It's a fact
-                yield theta_prime
+    Walking frame.parent visits exactly the bodies of the ancestor goals.
+    """
+    while frame is not None:
+        if frame.key == key:
+            return True
+        frame = frame.parent
+    return False
+
+
+def variant_key(goal):
+    """Key identifying goal up to a consistent renaming of its variables.
+
+    Variables are replaced by canonical ones numbered in order of first
+    occurrence, so p(X, X) and p(Y, Y) share a key but p(X, Y) does not. The
+    key is itself a hash-consed term, built over an explicit stack.
+    """
+    if goal.ground:
+        return goal
+    numbering = {}
+    memo = {}
+    stack = [goal]
+    while stack:
+        t = stack[-1]
+        if t in memo:
+            stack.pop()
+        elif t.ground:
+            memo[t] = t
+            stack.pop()
+        elif t.kind == VAR:
+            memo[t] = numbering.setdefault(t, Variable(None, len(numbering)))
+            stack.pop()
+        else:
+            pending = [arg for arg in t.args if arg not in memo]
+            if pending:
+                stack.extend(reversed(pending))  # leftmost first, for the numbering
             else:
-                # It's a rule with a body of subgoals
-                yield from fol_bc_and(kb, body, theta_prime, new_visited)
+                memo[t] = t.__class__(t.name, tuple(memo[arg] for arg in t.args))
+                stack.pop()
+    return memo[goal]
+
+
+class AndFrame:
+    """Continuation: the goals left in one clause body, then parent's goals.
+
+    key is the (goal, theta) the body was entered for, used for cycle checks
+    (see on_path). table is that goal's TableEntry, if any: when the body runs
+    out of goals, the proved instance of the goal is recorded there.
+    """
+    __slots__ = ('goals', 'key', 'table', 'parent')
+
+    def __init__(self, goals, key, table, parent):
+        self.goals = goals          # tuple of Predicates
+        self.key = key
+        self.table = table
+        self.parent = parent
+
+
+class TableEntry:
+    """Answers collected for one goal variant while it is being evaluated."""
+    __slots__ = ('goal', 'key', 'prunes', 'answers')
+
+    def __init__(self, goal, key, prunes):
+        self.goal = goal
+        self.key = key
+        self.prunes = prunes
+        self.answers = []
+
+
+def solve(kb, goals, theta):
+    """Prove the conjunction goals under theta; yield each solution theta.
+
+    A batch's table is stored, and its pooled frames freed, only when it is popped.
+    """
+    pool = {}  # Clause -> [free renamed frames]
+    stack = [(iter([(AndFrame(tuple(goals), None, None, None), theta)]), None, ())]
+    while stack:
+        alternatives, table, taken = stack[-1]
+        state = next(alternatives, None)
+        if state is None:
+            stack.pop()
+            if table is not None and kb.prunes == table.prunes:
+                kb.tables[table.key] = table.answers
+            for clause, renamed in taken:
+                pool[clause].append(renamed)
+            continue
+        frame, theta = state
+
+        # Unwind finished bodies, recording answers for tabled goals.
+        while frame is not None and not frame.goals:
+            if frame.table is not None:
+                frame.table.answers.append(substitute(frame.table.goal, theta))
+            frame = frame.parent
+        if frame is None:
+            yield theta
+            continue
+
+        goals = frame.goals
+        if kb.reorder_goals and len(goals) > 1:
+            i, current = select_goal(kb, goals, theta)
+        else:
+            i, current = 0, goal_instance(goals[0], theta, kb.occurs_check)
+        rest = AndFrame(goals[:i] + goals[i + 1:], frame.key, frame.table, frame.parent)
+
+        table = None
+        # Without the occurs check, answers may hold cyclic bindings that
+        # cannot be substituted into a table entry, so tabling is skipped.
+        if kb.tabling and kb.occurs_check:
+            table_key = variant_key(current)
+            answers = kb.tables.get(table_key)
+            if answers is not None:
+                stack.append((replay_table(kb, current, answers, theta, rest), None, ()))
+                continue
+            table = TableEntry(current, table_key, kb.prunes)
+
+        # Avoid infinite loops: skip a goal+theta already being proved further
+        # up the path. current is hash-consed and theta hashes incrementally,
+        # so comparing keys is O(1) unless two substitutions' hashes collide.
+        key = (current, theta)
+        if on_path(key, frame):
+            kb.prunes += 1
+            continue
+        taken = []
+        stack.append((resolve(kb, current, theta, key, table, rest, pool, taken), table, taken))
+
+
+def replay_table(kb, current, answers, theta, rest):
+    """Yield alternatives for current from a completed answer table."""
+    for answer in answers:
+        if not answer.ground:
+            answer = _renamer()(answer)
+        # answer first, so its fresh variables are the ones that get bound
+        theta_prime = unify(answer, current, theta, kb.occurs_check)
+        if theta_prime is not None:
+            yield rest, theta_prime
+
+
+def resolve(kb, current, theta, key, table, rest, pool, taken):
+    """Lazily yield (continuation, theta) alternatives for current, one clause at a time.
+
+    Frames drawn from pool are appended to taken so solve can return them.
+    """
+    def alternative(body, theta_prime):
+        if body or table is not None:
+            return AndFrame(tuple(body), key, table, rest), theta_prime
+        return rest, theta_prime
+
+    # A ground goal is answered by ground facts with one hash probe, no unify.
+    ground = current.ground
+    if ground and current.args in kb.fact_set.get((current.name, len(current.args)), ()):
+        yield alternative((), theta)
+
+    for clause in kb.fetch_clauses_for_goal(current):
+        if ground and clause.ground_fact:
+            continue  # already answered by the fact_set probe
+        if clause.match is not None:
+            matched = clause.match(current.args, theta, kb.occurs_check)
+            if matched is None:
+                continue
+            theta_prime, head_values = matched
+            if not clause.body:
+                yield alternative((), theta_prime)
+                continue
+            fresh = acquire_frame(clause, pool)
+            taken.append((clause, fresh))
+            yield alternative(clause.instantiate(head_values, fresh), theta_prime)
+        else:
+            clause_copy = acquire_frame(clause, pool)
+            theta_prime = unify(clause_copy.head, current, theta, kb.occurs_check)
+            if theta_prime is None:
+                pool[clause].append(clause_copy)
+                continue
+            taken.append((clause, clause_copy))
+            yield alternative(clause_copy.body, theta_prime)
+
+
+def acquire_frame(clause, pool):
+    """A renamed-apart frame for clause, reused from pool when one is free.
+
+    Frames are only reused within one solve call.
+    """
+    free = pool.setdefault(clause, [])
+    if free:
+        return free.pop()
+    if clause.match is not None:
+        return tuple(Variable(v.name, next(_VID_COUNTER))
+                     for v in clause.local_vars[len(clause.head_vars):])
+    return standardize_apart(clause)
+
+
+def fol_bc_or(kb, goal, theta):
+    """OR node: try all clauses whose head can unify with goal."""
+    return solve(kb, [goal], theta)
 
 
-def fol_bc_and(kb, goals, theta, visited):
+def fol_bc_and(kb, goals, theta):
     """AND node: ensure all subgoals succeed under theta."""
     if theta is None:
-        return
-    if not goals:
-        # No more goals: current theta is a solution
-        yield theta
-    else:
-        first, rest = goals[0], goals[1:]
-        for theta_prime in fol_bc_or(kb, first, theta, visited):
-            yield from fol_bc_and(kb, rest, theta_prime, visited)
-
-_counter = 0
-
-def standardize_apart(clause):
-    """Produce a variable-renamed copy of clause with unique variable names."""
-    global _counter
+        return iter(())
+    return solve(kb, goals, theta)
+
+
+def select_goal(kb, goals, theta):
+    """(index, goal under theta) of the conjunct to solve next.
+
+    Only a ground goal over ground facts alone (a single fact_set probe, which
+    always terminates) is moved ahead; other goals keep their written order.
+    """
+    first = None
+    for i, goal in enumerate(goals):
+        if (goal.name, len(goal.args)) in kb.rule_preds:
+            continue  # never moved ahead, so not worth substituting
+        current = goal_instance(goal, theta, kb.occurs_check)
+        if current.ground:
+            return i, current
+        if i == 0:
+            first = current
+    if first is None:
+        first = goal_instance(goals[0], theta, kb.occurs_check)
+    return 0, first
+
+def _renamer():
+    """Return a rename(expr) function mapping each variable to a fresh one.
+
+    The mapping is shared across calls to the returned function, so a head and
+    body renamed with it keep their variables linked.
+    """
     mapping = {}
     def rename(expr):
-        if isinstance(expr, Variable):
-            if expr not in mapping:
-                mapping[expr] = Variable(f"_{expr.name}{_counter}")
-            return mapping[expr]
-        if isinstance(expr, Function):
-            return Function(expr.name, [rename(arg) for arg in expr.args])
-        if isinstance(expr, Predicate):
-            return Predicate(expr.name, [rename(arg) for arg in expr.args])
-        return expr  # Constant
-
-    _counter += 1
+        if expr.ground:
+            return expr
+        memo = {}
+        stack = [expr]
+        while stack:
+            t = stack[-1]
+            if t in memo:
+                stack.pop()
+            elif t.ground:
+                memo[t] = t
+                stack.pop()
+            elif t.kind == VAR:
+                if t not in mapping:
+                    mapping[t] = Variable(t.name, next(_VID_COUNTER))
+                memo[t] = mapping[t]
+                stack.pop()
+            else:
+                pending = [arg for arg in t.args if arg not in memo]
+                if pending:
+                    stack.extend(pending)
+                else:
+                    memo[t] = t.__class__(t.name, tuple(memo[arg] for arg in t.args))
+                    stack.pop()
+        return memo[expr]
+    return rename
+
+def standardize_apart(clause):
+    """Produce a variable-renamed copy of clause with unique variable names.
+
+    Clauses are never mutated, so one without variables is returned as-is.
+    """
+    if not clause.has_vars:
+        return clause
+    if not clause.body:
+        return standardize_apart_fact(clause)
+    rename = _renamer()
     new_head = rename(clause.head)
     new_body = [rename(b) for b in clause.body]
     return Clause(new_head, new_body)
 
+def standardize_apart_fact(clause):
+    """standardize_apart for a body-less clause: only the head is renamed."""
+    if not clause.has_vars:
+        return clause
+    return Clause(_renamer()(clause.head))
+
+# -------------------------
+# Specialized clause matchers
+# -------------------------
+
+def compile_matcher(clause):
+    """Generate clause.match, a head matcher specialized to this clause.
+
+    match(args, theta, check_occurs) returns None or (theta, head_values).
+    """
+    args = clause.head.args
+    if any(arg.kind >= FUNC for arg in args):
+        return
+    namespace = {"unify": unify, "VAR": VAR}
+    lines = ["def match(args, theta, check_occurs):"]
+    head_vars = []
+    for i, arg in enumerate(args):
+        if arg.kind == CONST:
+            namespace[f"c{i}"] = arg
+            lines += [
+                f"    a = args[{i}]",
+                f"    if a is not c{i}:",
+                f"        if a.kind != VAR:",
+                f"            return None",
+                f"        theta = unify(a, c{i}, theta, check_occurs)",
+                f"        if theta is None:",
+                f"            return None",
+            ]
+        elif arg in head_vars:
+            lines += [
+                f"    theta = unify(v{head_vars.index(arg)}, args[{i}], theta, check_occurs)",
+                f"    if theta is None:",
+                f"        return None",
+            ]
+        else:
+            lines.append(f"    v{len(head_vars)} = args[{i}]")
+            head_vars.append(arg)
+    values = "".join(f"v{k}, " for k in range(len(head_vars)))
+    lines.append(f"    return theta, ({values})")
+    exec("\n".join(lines), namespace)
+    clause.head_vars = tuple(head_vars)
+    clause.match = namespace["match"]
+    if clause.body:
+        compile_body(clause)
+
+def compile_body(clause):
+    """Generate clause.instantiate, which builds a renamed-apart body.
+
+    instantiate(head_values, fresh) fills clause.local_vars by position.
+    """
+    local_vars = list(clause.head_vars)
+    def collect(t):
+        if t.kind == VAR:
+            if t not in local_vars:
+                local_vars.append(t)
+        elif t.kind >= FUNC:
+            for arg in t.args:
+                collect(arg)
+    for b in clause.body:
+        collect(b)
+    namespace = {"Function": Function, "Predicate": Predicate}
+
+    def emit(t):
+        if t.ground:
+            name = f"g{len(namespace)}"
+            namespace[name] = t
+            return name
+        if t.kind == VAR:
+            return f"f{local_vars.index(t)}"
+        cls = "Function" if t.kind == FUNC else "Predicate"
+        name = f"n{len(namespace)}"
+        namespace[name] = t.name
+        return f"{cls}({name}, ({''.join(f'{emit(arg)}, ' for arg in t.args)}))"
+
+    n_head = len(clause.head_vars)
+    lines = ["def instantiate(head_values, fresh):"]
+    if n_head:
+        lines.append(f"    {''.join(f'f{k}, ' for k in range(n_head))}= head_values")
+    if len(local_vars) > n_head:
+        lines.append(f"    {''.join(f'f{k}, ' for k in range(n_head, len(local_vars)))}= fresh")
+    lines.append(f"    return ({''.join(f'{emit(b)}, ' for b in clause.body)})")
+    exec("\n".join(lines), namespace)
+    clause.local_vars = tuple(local_vars)
+    clause.instantiate = namespace["instantiate"]
+
 # -------------------------
 # Example Usage
 # -------------------------
@@ -336,4 +892,15 @@ if __name__ == "__main__":
     else:
         print("NO (as expected for undefined predicate)")
 
+    # 6. Goal reordering must not change termination: loop(a) is ground but
+    # recurses forever, so it stays behind q(x), which fails first.
+    print("\nQuery: r  # r <- q(x), loop(a); no clauses for 'q'")
+    kb.add_clause(Clause(Predicate("loop", [x]), [Predicate("loop", [Function("f", [x])])]))
+    kb.add_clause(Clause(Predicate("r", []), [Predicate("q", [x]), Predicate("loop", [Constant("a")])]))
+    results_loop = list(kb.ask(Predicate("r", [])))
+    if results_loop:
+        print("ERROR: Unexpected proof for r")
+    else:
+        print("NO (as expected)")
+
     pass